@@ -15,6 +15,12 @@ https://github.com/ppannuto/python-titlecase
 which can be installed with the command:
 pip3 install titlecase
 
+Optional compilation:
+Helper functions are type annotated so the script can be compiled with
+mypyc (pip3 install mypy) for faster processing of large exports:
+mypyc --ignore-missing-imports zotero2wordpress.py
+python3 -c 'import zotero2wordpress; zotero2wordpress.main()' input.csv output.xml
+
 Title duplicates:
 WordPress will not import posts with the same title and post date
 (ignoring time of day). This script does not assign post dates, so the
@@ -24,29 +30,39 @@ error and not import the second post. This script detects title duplicates
 and appends "(2)" to the end. The title can be changed after import with
 the WordPress editor.
 
+Large exports:
+Exports of 5000 or more citations are converted in parallel worker
+processes on multi-core machines. Title duplicates are still resolved
+in export order.
+
 Version 1.1
 Updated to include Author tagging for Jean Cadigan.
 """
 
+import os
 import sys
+import re
 import csv
-import time
 import calendar
-import xml.etree.ElementTree as etree
+import datetime
+import errno
+import mmap
+from functools import lru_cache, partial
+from itertools import chain, islice
+from multiprocessing import Pool
+from typing import BinaryIO, Dict, Iterable, List, Optional, Pattern, Tuple, Union
+from xml.sax.saxutils import escape
 from titlecase import titlecase
 
+if sys.platform.startswith('linux'):
+    import fcntl
+
 if sys.version_info[0] < 3:
     raise 'Must be using Python 3, try: python3 zotero2wordpress.py input.csv output.xml'
 
-if len(sys.argv) < 2:
-    print('Input file not specified, try: python3 zotero2wordpress.py input.csv output.xml')
-    sys.exit()
+cached_titlecase = lru_cache(maxsize=None)(titlecase)
 
-if len(sys.argv) < 3:
-    print('Output file not specified, try: python3 zotero2wordpress.py input.csv output.xml')
-    sys.exit()
-
-def short_title(title):
+def short_title(title: str) -> str:
     """Extract title from 'Title: Substitle'.
 
     Based on colon separation convention.
@@ -54,10 +70,10 @@ def short_title(title):
     corresponding `subtitle()` function.
     """
     if ':' in title:
-        return titlecase(title.split(':', 2)[0].strip())
-    return titlecase(title.strip())
+        return cached_titlecase(title.split(':', 2)[0].strip())
+    return cached_titlecase(title.strip())
 
-def subtitle(title):
+def subtitle(title: str) -> Optional[str]:
     """Extract subtitle from 'Title: Substitle'.
     
     Based on colon separation convention.
@@ -67,109 +83,128 @@ def subtitle(title):
     if ':' in title:
         subtitle = title.split(':', 2)[1].strip()
         if len(subtitle) > 0:
-            return titlecase(subtitle)
+            return cached_titlecase(subtitle)
     return None
 
-def name_list(string):
+name_list_separator = re.compile(r'\s*;\s*')
+
+def name_list(string: str) -> List[str]:
     """Convert Zotero name list to Python name list.
     
     Input is a string of semicolon separated 'Lastname, Firstname' names.
     Output is a Python list of 'Firstname Lastname' names.
     """
     names = []
-    for name in string.split('; '):
-        if ', ' in name:
-            last_comma_first = name.split(', ', 2)
-            first = last_comma_first[1].strip()
-            last = last_comma_first[0].strip()
-            names.append(first + " " + last)
+    for name in name_list_separator.split(string):
+        if not name: continue
+        last, comma, first = name.partition(', ')
+        if comma:
+            names.append(first.strip() + ' ' + last.strip())
         else:
             names.append(name.strip())
     return names
 
-def unix_time(date_string):
-    """Convert Zotero date string to Python Unix time.
+zotero_date_pattern = re.compile(r'([0-9]{4})(?:-([0-9]{2})(?:-([0-9]{2}))?)?')
+date_specificities = {4: 'y', 7: 'ym', 10: 'ymd'}
+
+def parse_date(date_string: str) -> Tuple[Optional[str], Optional[str]]:
+    """Convert Zotero date string to Python Unix time and date specificity.
     
+    Returns a (unix_time, specificity) tuple of strings, where specificity
+    is 'ymd', 'ym', or 'y'. Returns (None, None) for unrecognized dates.
+    Raises ValueError for malformed or invalid 'YYYY-MM-DD' style dates.
     Defaults to 1st if day is missing.
     Defaults to January if month is missing.
     """
-    length = len(date_string)
-    if length == 10:
-        date_format = '%Y-%m-%d'
-    elif length == 7:
-        date_format = '%Y-%m'
-    elif length == 4:
-        date_format = '%Y'
-    else:
-        return None
-    return str(calendar.timegm(time.strptime(date_string, date_format)))
+    specificity = date_specificities.get(len(date_string))
+    if specificity is None:
+        return None, None
+    match = zotero_date_pattern.fullmatch(date_string)
+    if not match:
+        raise ValueError('Malformed Zotero date ' + repr(date_string))
+    year, month, day = match.groups()
+    date = datetime.date(int(year), int(month or 1), int(day or 1))
+    return str(calendar.timegm(date.timetuple())), specificity
 
-def date_specificity(date_string):
-    """Detect date specificity of Zotero date string.
-    
-    Returns 'ymd', 'ym', or 'y' string.
-    """
-    length = len(date_string)
-    if length == 10:
-        return 'ymd'
-    elif length == 7:
-        return 'ym'
-    elif length == 4:
-        return 'y'
-    return None    
-
-def key_value_string_value(key_value_string, key):
+key_value_patterns: Dict[str, Pattern[str]] = {}
+
+def key_value_string_value(key_value_string: Optional[str],
+                           key: Optional[str]) -> Optional[str]:
     """Extract value for key from Zotero key-value-string.
 
     Zotero 'Extra'' field stores data as a space separated string:
     'key1: value1 key2: value2 key3: value3'.
     This function extracts a value for a key from such a string. 
+    Compiled patterns are cached per key.
     """
-    if key_value_string is None or key is None:
+    if not key_value_string or not key:
         return None
-    words = key_value_string.split(' ')
-    for i in range(0, len(words)-1):
-        if words[i] == key + ':':
-            return words[i+1]
+    pattern = key_value_patterns.get(key)
+    if pattern is None:
+        pattern = re.compile(r'(?:^|\s)' + re.escape(key) + r':\s*(\S+)')
+        key_value_patterns[key] = pattern
+    match = pattern.search(key_value_string)
+    if match:
+        return match.group(1)
     return None
 
-def CDATA(string):
-    """Temporarily wrap a string in a CDATA marker.
-    
-    Wraps a string in '[[CDATA[[' ']]CDATA]]' markers.
-    For later conversion to '<![CDATA[' ']]>' markers,
-    after XML conversion.
+def CDATA(string: str) -> str:
+    """Wrap a string in a CDATA section.
+
+    Any ']]>' inside the string is split across two CDATA sections,
+    so the string is preserved verbatim.
     """
-    return '[[CDATA[[' + string + ']]CDATA]]'
-
-def indent(elem, level = 0):
-    """Prettify XML indenting."""
-    i = "\n" + level * '  '
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + '  '
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
-fileInName = sys.argv[1]
-
-rss = etree.Element('rss')
-rss.set('version', '2.0')
-rss.set('xmlns:excerpt', 'http://wordpress.org/export/1.2/excerpt/')
-rss.set('xmlns:content', 'http://purl.org/rss/1.0/modules/content/')
-rss.set('xmlns:wfw', 'http://wellformedweb.org/CommentAPI/')
-rss.set('xmlns:dc', 'http://purl.org/dc/elements/1.1/')
-rss.set('xmlns:wp', 'http://wordpress.org/export/1.2/')
-channel = etree.SubElement(rss, 'channel')
-wxr_version = etree.SubElement(channel, 'wp:wxr_version')
-wxr_version.text = '1.2'
+    return '<![CDATA[' + string.replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+element_template = '\n      <{key}>{value}</{key}>'
+tag_template = '\n      <category domain="post_tag" nicename="{slug}">{name}</category>'
+meta_template = (
+    '\n      <wp:postmeta>'
+    '\n        <wp:meta_key>{key}</wp:meta_key>'
+    '\n        <wp:meta_value>{value}</wp:meta_value>'
+    '\n      </wp:postmeta>'
+)
+
+def add_element(item: List[str], key: str, value: Optional[str]) -> None:
+    """Add an XML escaped text element to an item, skipping empty values."""
+    if not value or value == '': return
+    item.append(element_template.format(key=key, value=escape(value)))
+
+def add_markup_element(item: List[str], key: str, markup: str) -> None:
+    """Add an element containing unescaped XML markup to an item."""
+    item.append(element_template.format(key=key, value=markup))
+
+def add_tag(item: List[str], name: str, slug: str) -> None:
+    """Add a post tag category to an item, skipping empty values."""
+    if not name or name == '' or not slug or slug == '': return
+    item.append(tag_template.format(
+        slug=escape(slug, {'"': '&quot;'}), name=escape(name)))
+
+def add_meta(item: List[str], key: str, value: Optional[str]) -> None:
+    """Add a post meta key-value pair to an item, skipping empty values."""
+    if not value or value == '': return
+    item.append(meta_template.format(key=key, value=escape(value)))
+
+rss_header = (
+    '<rss version="2.0"'
+    ' xmlns:excerpt="http://wordpress.org/export/1.2/excerpt/"'
+    ' xmlns:content="http://purl.org/rss/1.0/modules/content/"'
+    ' xmlns:wfw="http://wellformedweb.org/CommentAPI/"'
+    ' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+    ' xmlns:wp="http://wordpress.org/export/1.2/">\n'
+    '  <channel>\n'
+    '    <wp:wxr_version>1.2</wp:wxr_version>'
+).encode()
+rss_footer = '\n  </channel>\n</rss>\n'.encode()
+item_header = (
+    '\n    <item>'
+    '\n      <wp:post_type>publications</wp:post_type>'
+).encode()
+input_buffer_size = 1 << 20
+output_flush_size = 1 << 20
+direct_block_size = 4096
+parallel_row_threshold = 5000
+parallel_chunk_size = 256
 
 author_search_dictionary = {
     'Juengst':    'Eric Juengst',
@@ -183,82 +218,222 @@ author_search_dictionary = {
     'Walker':     'Rebecca Walker',
     'Winstanly':  'Louise Winstanly',
 }
+author_tag_dictionary = {key: (name, name.lower().replace(' ', '-'))
+    for key, name in author_search_dictionary.items()}
 
-used_titles = {}
-title_collision_did_occur = False
+zotero_columns = (
+    'Title', 'Abstract Note', 'Author', 'Editor', 'Reviewed Author', 'Date',
+    'Extra',
+)
+simple_meta_fields = (
+    ('wpcf-pub-type',            'Item Type'),
+    ('wpcf-pub-journal-book',    'Publication Title'),
+    ('wpcf-pub-volume',          'Volume'),
+    ('wpcf-pub-issue',           'Issue'),
+    ('wpcf-pub-pages',           'Pages'),
+    ('wpcf-pub-doi',             'DOI'),
+    ('wpcf-pub-url',             'Url'),
+    ('wpcf-pub-publisher',       'Publisher'),
+    ('wpcf-pub-publisher-place', 'Place'),
+    ('wpcf-pub-zotero-key',      'Key'),
+)
 
-with open(fileInName, encoding='utf-8-sig') as csv_file:
-    reader = csv.DictReader(csv_file)
+def render_item(row: List[str], columns: Tuple[int, ...],
+                meta_columns: Tuple[Tuple[str, int], ...]) -> Tuple[str, bytes]:
+    """Convert a Zotero CSV row to WordPress XML item parts.
+
+    Returns a (title, tail) tuple, where `columns` holds the row
+    positions of `zotero_columns` and `meta_columns` pairs each
+    `simple_meta_fields` meta key with its row position. The constant
+    `item_header` and the title element are left out, so title duplicates
+    can be resolved in input order by `write_items()`.
+    """
+    (title_column, abstract_column, author_column, editor_column,
+        reviewed_author_column, date_column, extra_column) = columns
+    item: List[str] = []
+    add_element(item, 'dc:creator', 'anonymous')
+    add_markup_element(item, 'content:encoded', CDATA(row[abstract_column]))
+    authors = (row[author_column] + '; ' + row[editor_column] + '; '
+        + row[reviewed_author_column])
+    for key, (name, slug) in author_tag_dictionary.items():
+        if key in authors:
+            add_tag(item, name, slug)
+    for key, column in meta_columns:
+        value = row[column]
+        if value:
+            add_meta(item, key, value)
+    add_meta(item, 'wpcf-pub-subtitle', subtitle(row[title_column]))
+    date, date_specificity = parse_date(row[date_column])
+    add_meta(item, 'wpcf-pub-date', date)
+    add_meta(item, 'wpcf-pub-date-specificity', date_specificity)
+    add_meta(item, 'wpcf-pub-pmcid', key_value_string_value(row[extra_column], 'PMCID'))
+    for name in name_list(row[author_column]):
+        add_meta(item, 'wpcf-pub-author', name)
+    for name in name_list(row[editor_column]):
+        add_meta(item, 'wpcf-pub-editor', name)
+    for name in name_list(row[reviewed_author_column]):
+        add_meta(item, 'wpcf-pub-reviewed-author', name)
+    item.append('\n    </item>')
+    return short_title(row[title_column]), ''.join(item).encode()
+
+class DirectFile:
+    """Write-only output file opened with O_DIRECT on Linux.
+
+    Bypasses the page cache by staging data in a page aligned buffer and
+    writing it in whole blocks. The unaligned tail is written after clearing
+    O_DIRECT, which also serves as a fallback if the file system rejects a
+    direct write. Use `open_output()` rather than creating one directly.
+    """
+
+    def __init__(self, fd: int, buffer_size: int = output_flush_size) -> None:
+        self.fd = fd
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.buffer_size = buffer_size
+        self.fill = 0
+
+    def __enter__(self) -> 'DirectFile':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def write(self, data: Union[bytes, bytearray]) -> int:
+        """Stage data in the aligned buffer, writing out full buffers."""
+        view = memoryview(data)
+        while len(view):
+            size = min(len(view), self.buffer_size - self.fill)
+            self.buffer[self.fill:self.fill + size] = view[:size]
+            self.fill += size
+            view = view[size:]
+            if self.fill == self.buffer_size:
+                self.flush_blocks()
+        return len(data)
+
+    def flush_blocks(self) -> None:
+        """Write all whole blocks in the buffer, keeping any partial block."""
+        aligned = self.fill - self.fill % direct_block_size
+        if not aligned: return
+        with memoryview(self.buffer) as view:
+            self.write_all(view[:aligned])
+        self.buffer.move(0, aligned, self.fill - aligned)
+        self.fill -= aligned
+
+    def write_all(self, view: memoryview) -> None:
+        """Write a buffer to the file, dropping O_DIRECT if it is rejected."""
+        while len(view):
+            try:
+                written = os.write(self.fd, view)
+            except OSError as error:
+                if error.errno != errno.EINVAL or not self.clear_direct(): raise
+                continue
+            view = view[written:]
+
+    def clear_direct(self) -> bool:
+        """Clear O_DIRECT on the file, returning whether it was set."""
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        if not flags & os.O_DIRECT:
+            return False
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+        return True
+
+    def close(self) -> None:
+        """Write the buffered tail and close the file."""
+        try:
+            self.flush_blocks()
+            if self.fill:
+                self.clear_direct()
+                with memoryview(self.buffer) as view:
+                    self.write_all(view[:self.fill])
+                self.fill = 0
+        finally:
+            os.close(self.fd)
+            self.buffer.close()
+
+def open_output(file_name: str) -> Union[BinaryIO, DirectFile]:
+    """Open the output file, with O_DIRECT where Linux supports it.
+
+    Falls back to an ordinary binary file on other platforms and on file
+    systems that refuse O_DIRECT.
+    """
+    if sys.platform.startswith('linux') and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(file_name,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
+        except OSError as error:
+            if error.errno != errno.EINVAL: raise
+        else:
+            return DirectFile(fd)
+    return open(file_name, 'wb')
+
+def write_items(xmlFile: Union[BinaryIO, DirectFile],
+                items: Iterable[Tuple[str, bytes]]) -> Tuple[int, bool]:
+    """Write rendered items as a WordPress XML document.
+
+    Title duplicates get a " (2)" style suffix in input order.
+    Returns the item count and whether any title duplicate occurred.
+    """
+    used_titles: Dict[str, int] = {}
+    title_collision_did_occur = False
+    output_buffer = bytearray(rss_header)
     count = 0
-    for row in reader:
-        if row['Item Type'] == '': continue
-        item = etree.SubElement(channel, 'item')
-        def add_element(key, value):
-            if not value or value == '': return
-            subelement = etree.SubElement(item, key)
-            subelement.text = value
-        def add_tag(name, slug):
-            if not name or name == '' or not slug or slug == '': return
-            category = etree.SubElement(item, 'category')
-            category.set('domain', 'post_tag')
-            category.set('nicename', slug)
-            category.text = name
-        def add_meta(key, value):
-            if not value or value == '': return
-            postmeta = etree.SubElement(item, 'wp:postmeta')
-            meta_key = etree.SubElement(postmeta, 'wp:meta_key')
-            meta_key.text = key
-            meta_value = etree.SubElement(postmeta, 'wp:meta_value')
-            meta_value.text = value
-        add_element('wp:post_type', 'publications')
-        title = short_title(row['Title'])
-        while title in used_titles:
-            use_count = used_titles[title] + 1
-            used_titles[title] = use_count
+    for title, tail in items:
+        use_count = used_titles.get(title, 0) + 1
+        used_titles[title] = use_count
+        while use_count > 1:
             new_title = title + ' (' + str(use_count)  + ')'
             print('Title duplicate "' + title + '" changed to "' + new_title + '"')
             title_collision_did_occur = True
             title = new_title
-        used_titles[title] = 1
-        add_element('title', title)
-        add_element('dc:creator', 'anonymous')
-        add_element('content:encoded', CDATA(row['Abstract Note']))
-        for key in author_search_dictionary.keys():
-            if key in (row['Author']+row['Editor']+row['Reviewed Author']):
-                name = author_search_dictionary[key]
-                slug = name.lower().replace(' ', '-')
-                add_tag(name, slug)
-        add_meta('wpcf-pub-type', row['Item Type'])
-        add_meta('wpcf-pub-subtitle', subtitle(row['Title']))
-        add_meta('wpcf-pub-date', unix_time(row['Date']))
-        add_meta('wpcf-pub-date-specificity', date_specificity(row['Date']))
-        for name in name_list(row['Author']):
-            add_meta('wpcf-pub-author', name)
-        add_meta('wpcf-pub-journal-book', row['Publication Title'])
-        add_meta('wpcf-pub-volume', row['Volume'])
-        add_meta('wpcf-pub-issue', row['Issue'])
-        add_meta('wpcf-pub-pages', row['Pages'])
-        add_meta('wpcf-pub-doi', row['DOI'])
-        add_meta('wpcf-pub-pmcid', key_value_string_value(row['Extra'], 'PMCID'))
-        add_meta('wpcf-pub-url', row['Url'])
-        for name in name_list(row['Editor']):
-            add_meta('wpcf-pub-editor', name)
-        add_meta('wpcf-pub-publisher', row['Publisher'])
-        add_meta('wpcf-pub-publisher-place', row['Place'])
-        for name in name_list(row['Reviewed Author']):
-            add_meta('wpcf-pub-reviewed-author', name)
-        add_meta('wpcf-pub-zotero-key', row['Key'])
+            use_count = used_titles.get(title, 0) + 1
+            used_titles[title] = use_count
+        output_buffer += item_header
+        title_element: List[str] = []
+        add_element(title_element, 'title', title)
+        output_buffer += ''.join(title_element).encode()
+        output_buffer += tail
+        if len(output_buffer) >= output_flush_size:
+            xmlFile.write(output_buffer)
+            output_buffer.clear()
         count += 1
+    output_buffer += rss_footer
+    xmlFile.write(output_buffer)
+    return count, title_collision_did_occur
 
-if title_collision_did_occur:
-    print("(Title duplicate changes can be changed back after WordPress import)")
+def main() -> None:
+    """Convert the input CSV file named on the command line to XML."""
+    if len(sys.argv) < 2:
+        print('Input file not specified, try: python3 zotero2wordpress.py input.csv output.xml')
+        sys.exit()
 
-indent(rss)
-xmlString = etree.tostring(rss, encoding='utf-8')
-xmlString = xmlString.replace('[[CDATA[['.encode(), '<![CDATA['.encode())
-xmlString = xmlString.replace(']]CDATA]]'.encode(), ']]>'.encode())
+    if len(sys.argv) < 3:
+        print('Output file not specified, try: python3 zotero2wordpress.py input.csv output.xml')
+        sys.exit()
+
+    fileInName = sys.argv[1]
+    fileOutName = sys.argv[2]
+
+    with open(fileInName, encoding='utf-8-sig', newline='', buffering=input_buffer_size) as csv_file, \
+            open_output(fileOutName) as xmlFile:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        columns = tuple(header.index(name) for name in zotero_columns)
+        meta_columns = tuple((key, header.index(name)) for key, name in simple_meta_fields)
+        item_type_column = header.index('Item Type')
+        rows = (row for row in reader if row and row[item_type_column] != '')
+        render = partial(render_item, columns=columns, meta_columns=meta_columns)
+        first_rows = list(islice(rows, parallel_row_threshold))
+        all_rows = chain(first_rows, rows)
+        if len(first_rows) < parallel_row_threshold or (os.cpu_count() or 1) < 2:
+            count, title_collision_did_occur = write_items(xmlFile, map(render, all_rows))
+        else:
+            with Pool() as pool:
+                items = pool.imap(render, all_rows, parallel_chunk_size)
+                count, title_collision_did_occur = write_items(xmlFile, items)
+
+    if title_collision_did_occur:
+        print("(Title duplicate changes can be changed back after WordPress import)")
 
-fileOutName = sys.argv[2]
-with open(fileOutName, "wb") as xmlFile:
-    xmlFile.write(xmlString)
     print(str(count) + ' citations xml encoded to ' + fileOutName)
+
+if __name__ == '__main__':
+    main()